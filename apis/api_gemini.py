@@ -1,13 +1,67 @@
 import os
+import asyncio
+import contextlib
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
-import json
+import orjson
 import filetype
-from typing import Any
+from typing import Any, List, Optional, Tuple
+from pydantic import BaseModel
+
+from services import llm_cache
 
 load_dotenv()
 
+# Comprobantes enviados en una misma llamada a Gemini
+GEMINI_BATCH_SIZE = int(os.getenv("GEMINI_BATCH_SIZE", "4"))
+# Reintentos cuando Gemini devuelve JSON inválido (se le reenvía el error)
+GEMINI_JSON_RETRIES = int(os.getenv("GEMINI_JSON_RETRIES", "2"))
+# Subir al cambiar el prompt/esquema para invalidar la caché
+PROMPT_VERSION = "v2"
+
+# Marcas 'ftyp' de contenedores ISO-BMFF que usan HEIC/HEIF
+_HEIC_BRANDS = {b"heic", b"heix", b"heim", b"heis"}
+_HEIF_BRANDS = {b"mif1", b"msf1", b"heif"}
+
+# Respaldo por extensión cuando la firma no identifica el archivo
+EXT2MIME = {
+    "pdf": "application/pdf",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "webp": "image/webp",
+}
+
+def sniff_mime(b: bytes) -> Optional[str]:
+    """ Detecta PDF y las imágenes soportadas mirando solo los primeros 12 bytes. """
+    head = bytes(b[:12])
+    if head.startswith(b"%PDF-"):
+        return "application/pdf"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:8] == b"ftyp":
+        if head[8:12] in _HEIC_BRANDS:
+            return "image/heic"
+        if head[8:12] in _HEIF_BRANDS:
+            return "image/heif"
+    return None
+
+class ComprobanteExtraido(BaseModel):
+    """ Esquema de salida estructurada que se le exige a Gemini. """
+    numRucE: str
+    numRucR: str
+    codComp: str
+    numeroSerie: str
+    numero: str
+    fechaEmision: str
+    monto: str
+    faltantes: int
+
 class ExtractorGemini:
     def __init__(self):
         self.client = genai.Client()
@@ -31,62 +85,180 @@ class ExtractorGemini:
             "image/heif",
         ]
         self.supported_document_mimes = ["application/pdf"]
+        self.batch_size = max(1, GEMINI_BATCH_SIZE)
 
-    async def extraer_datos(self, contenido, filename):
-        data_comp:Any={}
-
-        detected_mime_type = None
-        try:
-            kind = filetype.guess(contenido)
-            if kind:
-                detected_mime_type = kind.mime
-        except Exception as e:
-            print(f"Error al detectar el tipo de archivo para {filename}: {e}")
-            pass
+    def _detectar_mime(self, contenido, filename):
+        """ Retorna (mime a enviar | None, mime detectado por firma | None). """
+        detected_mime_type = sniff_mime(contenido)
+        if detected_mime_type is None:
+            # Firma poco común: recién aquí se recorre la tabla completa de filetype
+            try:
+                kind = filetype.guess(contenido)
+                if kind:
+                    detected_mime_type = kind.mime
+            except Exception as e:
+                print(f"Error al detectar el tipo de archivo para {filename}: {e}")
+                pass
         
-        mime_type_to_send = None
+        _, dot, ext = (filename or "").rpartition(".")
+        ext_mime = EXT2MIME.get(ext.lower()) if dot else None
 
-        if filename.lower().endswith(".pdf"):
-            mime_type_to_send = "application/pdf"
-        elif detected_mime_type and detected_mime_type in self.supported_image_mimes:
+        if ext_mime == "application/pdf":
+            mime_type_to_send = ext_mime
+        elif detected_mime_type and (detected_mime_type in self.supported_image_mimes or detected_mime_type in self.supported_document_mimes):
             mime_type_to_send = detected_mime_type
-        elif filename.lower().endswith((".jpg", ".jpeg")):
-            mime_type_to_send = "image/jpeg"
-        elif filename.lower().endswith(".png"):
-            mime_type_to_send = "image/png"
-        elif filename.lower().endswith(".webp"):
-            mime_type_to_send = "image/webp"
+        else:
+            mime_type_to_send = ext_mime
+
+        return mime_type_to_send, detected_mime_type
+
+    async def _generar(self, parts: List[types.Part], prompt: str, schema: Any) -> Any:
+        """
+        Llama a Gemini en modo JSON (con esquema) y parsea la respuesta.
+        Si llega JSON inválido, reintenta hasta GEMINI_JSON_RETRIES veces indicándole el error.
+        """
+        config = types.GenerateContentConfig(response_mime_type="application/json", response_schema=schema)
+        contents = [types.Content(role="user", parts=[*parts, types.Part.from_text(text=prompt)])]
+        data_comp: Any = {}
+
+        for _ in range(GEMINI_JSON_RETRIES + 1):
+            try:
+                response = await self.client.aio.models.generate_content(
+                    model=os.getenv('GEMINI_MODEL'),
+                    contents=contents,
+                    config=config,
+                )
+            except Exception as e:
+                return {"error": f"{e}"}
+
+            raw_text = response.text
+            if not raw_text:
+                return {"error": "No se pudo extraer información"}
+
+            try:
+                return orjson.loads(raw_text)
+            except orjson.JSONDecodeError as e:
+                data_comp = {"error": f"Error al procesar el JSON: {e}", "respuesta_bruta": raw_text}
+                contents += [
+                    types.Content(role="model", parts=[types.Part.from_text(text=raw_text)]),
+                    types.Content(role="user", parts=[types.Part.from_text(
+                        text=f"La respuesta anterior no es JSON válido ({e}). Devuelve SOLO el JSON corregido."
+                    )]),
+                ]
+
+        return data_comp
+
+    async def _cache_key(self, contenido, digest: Optional[str] = None) -> Optional[str]:
+        # Si el llamador ya hasheó el archivo original, se reutiliza ese digest
+        model = os.getenv('GEMINI_MODEL') or ""
+        if digest is not None:
+            return llm_cache.cache_key(digest, model, PROMPT_VERSION)
+        return await llm_cache.cache_key_async(contenido, model, PROMPT_VERSION)
+
+    def _cachear(self, key, data_comp) -> None:
+        # Solo se guardan extracciones exitosas
+        if isinstance(data_comp, dict) and "error" not in data_comp:
+            llm_cache.set(key, data_comp)
+
+    async def extraer_datos(self, contenido, filename):
+        key = await self._cache_key(contenido)
+        cached = llm_cache.get(key)
+        if cached is not None:
+            return cached
+
+        data_comp = await self._extraer_uno(contenido, filename)
+        self._cachear(key, data_comp)
+        return data_comp
+
+    async def _extraer_uno(self, contenido, filename):
+        mime_type_to_send, detected_mime_type = self._detectar_mime(contenido, filename)
 
         if mime_type_to_send is None:
             return ({
                 "error": f"Tipo de archivo no soportado o no detectado: {filename}. Tipo MIME detectado: {detected_mime_type}"
             })
 
-        part = types.Part.from_bytes(data=contenido, mime_type=mime_type_to_send)
-
-        try:
-            response = self.client.models.generate_content(
-                model=os.getenv('GEMINI_MODEL'),
-                contents=[part, self.prompt]
-            )
-            if response.text:
-                raw_text = response.text
-                cleaned_text = raw_text.strip() # Eliminar espacios en blanco al inicio/fin
-
-                # Detectar y eliminar el bloque de código Markdown
-                if cleaned_text.startswith("```json") and cleaned_text.endswith("```"):
-                    # Eliminar "```json\n" (7 caracteres) y "```" (3 caracteres)
-                    cleaned_text = cleaned_text[7:-3].strip()
-
-                try:
-                    data_comp= json.loads(cleaned_text) # Intentar parsear el texto limpio
-                except json.JSONDecodeError as e:
-                    data_comp= {"error": f"Error al procesar el JSON (después de limpieza): {e}", "respuesta_bruta": raw_text, "texto_intentado_parsear": cleaned_text}
-                except Exception as e:
-                        data_comp= {"error": f"Error inesperado al procesar la respuesta: {e}", "respuesta_bruta": raw_text}
+        return await self._extraer_part(types.Part.from_bytes(data=contenido, mime_type=mime_type_to_send))
+
+    async def _extraer_part(self, part):
+        return await self._generar([part], self.prompt, ComprobanteExtraido)
+
+    async def _extraer_grupo(self, parts: List[types.Part], sem: Optional[asyncio.Semaphore] = None) -> List[Any]:
+        """
+        Envía varios comprobantes en UNA sola llamada y mapea el arreglo devuelto por posición.
+        Si la respuesta es un arreglo de otro tamaño, reintenta archivo por archivo reutilizando
+        los mismos Part (sin volver a detectar el MIME ni reconstruirlos). Si la llamada falló
+        (cuota, timeout, 5xx), el error se copia a cada archivo: reintentar solo multiplicaría las llamadas.
+        Cada llamada, incluidos los reintentos, ocupa un cupo de 'sem'.
+        """
+        limite = sem or contextlib.nullcontext()
+
+        if len(parts) == 1:
+            async with limite:
+                return [await self._extraer_part(parts[0])]
+
+        prompt = self.prompt + f"""
+        Se adjuntan {len(parts)} archivos, cada uno es un comprobante distinto.
+        Devuelve un ARREGLO JSON con exactamente {len(parts)} objetos con el esquema anterior, en el mismo orden de los archivos.
+        """
+
+        async with limite:
+            datos = await self._generar(parts, prompt, list[ComprobanteExtraido])
+
+        if isinstance(datos, list):
+            if len(datos) == len(parts):
+                return datos
+
+            # Respuesta desalineada: modo un-archivo-por-llamada
+            async def _uno(part):
+                async with limite:
+                    return await self._extraer_part(part)
+
+            return list(await asyncio.gather(*[_uno(part) for part in parts]))
+
+        if not (isinstance(datos, dict) and "error" in datos):
+            datos = {"error": "Respuesta inesperada del modelo para el lote", "respuesta_bruta": datos}
+        return [dict(datos) for _ in parts]
+
+    async def extraer_lote(
+        self,
+        archivos: List[Tuple[bytes, str]],
+        sem: Optional[asyncio.Semaphore] = None,
+        digests: Optional[List[Optional[str]]] = None,
+    ) -> List[Any]:
+        """
+        Extrae datos de varios archivos agrupando hasta GEMINI_BATCH_SIZE comprobantes por llamada.
+        'digests' (alineado con 'archivos') evita volver a hashear lo que el llamador ya hasheó.
+        Retorna una lista alineada con 'archivos'.
+        """
+        resultados: List[Any] = [None] * len(archivos)
+        validos: List[Tuple[int, types.Part]] = []
+        digests = digests or [None] * len(archivos)
+        claves = await asyncio.gather(*[self._cache_key(contenido, d) for (contenido, _), d in zip(archivos, digests)])
+
+        for i, (contenido, filename) in enumerate(archivos):
+            cached = llm_cache.get(claves[i])
+            if cached is not None:
+                resultados[i] = cached
+                continue
+
+            mime_type_to_send, detected_mime_type = self._detectar_mime(contenido, filename)
+            if mime_type_to_send is None:
+                resultados[i] = {
+                    "error": f"Tipo de archivo no soportado o no detectado: {filename}. Tipo MIME detectado: {detected_mime_type}"
+                }
             else:
-                data_comp={"error": "No se pudo extraer información"}
-        except Exception as e:
-                data_comp={"error": f"{e}"}
+                # Un solo Part por archivo, compartido por el lote y su posible reintento
+                validos.append((i, types.Part.from_bytes(data=contenido, mime_type=mime_type_to_send)))
+
+        grupos = [validos[k:k + self.batch_size] for k in range(0, len(validos), self.batch_size)]
+
+        async def _correr(grupo):
+            return await self._extraer_grupo([part for _, part in grupo], sem)
+
+        for grupo, datos in zip(grupos, await asyncio.gather(*[_correr(g) for g in grupos])):
+            for (i, _), data_comp in zip(grupo, datos):
+                resultados[i] = data_comp
+                self._cachear(claves[i], data_comp)
 
-        return data_comp
\ No newline at end of file
+        return resultados
@@ -1,8 +1,9 @@
 # integrations/sunat.py
 from __future__ import annotations
-import os, time, re
+import os, time, re, asyncio, threading
 from typing import Dict, Any, List, Tuple, Optional
 
+import httpx
 import requests
 
 SUNAT_CLIENT_ID = os.getenv("SUNAT_CLIENT_ID")
@@ -12,13 +13,22 @@ SUNAT_RUC_CONSULTANTE = os.getenv("SUNAT_RUC_CONSULTANTE", "")
 BASE_TOKEN_URL = "https://api-seguridad.sunat.gob.pe/v1/clientesextranet/{client_id}/oauth2/token"
 VALIDAR_URL_TMPL = "https://api.sunat.gob.pe/v1/contribuyente/contribuyentes/{ruc}/validarcomprobante"
 
+# Validaciones simultáneas contra SUNAT por lote
+SUNAT_MAX_CONCURRENCY = int(os.getenv("SUNAT_MAX_CONCURRENCY", "8"))
+
+RUC_RE = re.compile(r"\d{11}")
+
 def _is_valid_ruc(ruc: str) -> bool:
-    return bool(re.fullmatch(r"\d{11}", ruc or ""))
+    return RUC_RE.fullmatch(ruc or "") is not None
 
 class SunatTokenManager:
-    """ Cachea el access_token y renueva proactivamente. """
+    """
+    Cachea el access_token y renueva proactivamente.
+    El token vive en la clase: todas las instancias del proceso comparten el mismo.
+    """
     _cached_token: Optional[str] = None
     _expires_at: float = 0.0
+    _lock = threading.Lock()
 
     def __init__(self, client_id: Optional[str] = None, client_secret: Optional[str] = None):
         self.client_id = client_id or SUNAT_CLIENT_ID
@@ -39,21 +49,39 @@ class SunatTokenManager:
         payload = resp.json()
         return payload["access_token"], int(payload.get("expires_in", 300))
 
-    def get_token(self) -> str:
-        now = time.time()
-        if self._cached_token and now < (self._expires_at - 60):  # margen 60s
-            return self._cached_token
-        token, expires_in = self._request_token()
-        self._cached_token = token
-        self._expires_at = now + expires_in
-        return token
+    @classmethod
+    def _cached(cls) -> Optional[str]:
+        if cls._cached_token and time.time() < (cls._expires_at - 60):  # margen 60s
+            return cls._cached_token
+        return None
 
-    def refresh(self) -> str:
-        token, expires_in = self._request_token()
-        self._cached_token = token
-        self._expires_at = time.time() + expires_in
+    @classmethod
+    def _store(cls, token: str, expires_in: int, now: float) -> str:
+        cls._cached_token = token
+        cls._expires_at = now + expires_in
         return token
 
+    def get_token(self) -> str:
+        token = self._cached()
+        if token:
+            return token
+        with self._lock:
+            # Double-checked: otro hilo pudo renovarlo mientras esperábamos
+            token = self._cached()
+            if token:
+                return token
+            now = time.time()
+            token, expires_in = self._request_token()
+            return self._store(token, expires_in, now)
+
+    def refresh(self, stale: Optional[str] = None) -> str:
+        """ Fuerza la renovación; si 'stale' ya fue reemplazado por otro hilo, devuelve el vigente. """
+        with self._lock:
+            if stale is not None and self._cached_token and self._cached_token != stale:
+                return self._cached_token
+            token, expires_in = self._request_token()
+            return self._store(token, expires_in, time.time())
+
 class SunatClient:
     """ Valida comprobantes (lote) y maneja el token internamente. """
 
@@ -67,6 +95,17 @@ class SunatClient:
         self.ruc = (ruc_consultante or SUNAT_RUC_CONSULTANTE or "").strip()
         if not _is_valid_ruc(self.ruc):
             raise RuntimeError(f"RUC consultante inválido: '{self.ruc}'")
+        self._token: Optional[str] = None
+        self._token_lock = asyncio.Lock()
+        # Un solo pool HTTP/2 por cliente: las conexiones TLS a SUNAT se reutilizan entre lotes
+        self.http = httpx.AsyncClient(
+            http2=True,
+            timeout=25,
+            limits=httpx.Limits(max_keepalive_connections=32),
+        )
+
+    async def aclose(self) -> None:
+        await self.http.aclose()
         
     def _build_body(self, comp: Dict[str, Any]) -> Dict[str, Any]:
         body = {
@@ -81,7 +120,7 @@ class SunatClient:
             body["monto"] = monto
         return body
 
-    def _post_validar(self, comp: Dict[str, Any], token: str) -> requests.Response:
+    async def _post_validar(self, comp: Dict[str, Any], token: str) -> httpx.Response:
         url = VALIDAR_URL_TMPL.format(ruc=comp.get("numRucR"))
         body = self._build_body(comp)
         headers = {
@@ -89,33 +128,48 @@ class SunatClient:
             "Content-Type": "application/json",
             "Accept": "application/json",
         }
-        return requests.post(url, headers=headers, json=body, timeout=25)
+        return await self.http.post(url, headers=headers, json=body)
 
-    def validar_lote(self, comps: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """ Retorna lista alineada con comps: { ok:bool, status:int, payload:dict|str, body_enviado:dict } """
-        token = self.token_mgr.get_token()
-        out: List[Dict[str, Any]] = []
+    async def prefetch_token(self) -> str:
+        """ Deja el token en caché sin bloquear el event loop (para solaparlo con otro trabajo). """
+        return await asyncio.to_thread(self.token_mgr.get_token)
 
-        for comp in comps:
+    async def _refresh_token(self, stale: str) -> str:
+        """ Single-flight: si varias validaciones reciben 401, solo una renueva el token. """
+        async with self._token_lock:
+            if self._token == stale:
+                self._token = await asyncio.to_thread(self.token_mgr.refresh, stale)
+            return self._token
 
-            compAux = comp['comp_data']
+    async def _one(self, sem: asyncio.Semaphore, comp: Dict[str, Any]) -> Dict[str, Any]:
+        compAux = comp['comp_data']
 
-            resp = self._post_validar(compAux, token)
+        async with sem:
+            token = self._token
+            resp = await self._post_validar(compAux, token)
 
             if resp.status_code == 401:
-                token = self.token_mgr.refresh()
-                resp = self._post_validar(compAux, token)
-
-            try:
-                payload = resp.json()
-            except Exception:
-                payload = {"raw": resp.text}
-
-            out.append({
-                "ok": 200 <= resp.status_code < 300,
-                "status": resp.status_code,
-                "payload": payload,
-                "data_empleada": comp,
-            })
-
-        return out
\ No newline at end of file
+                token = await self._refresh_token(token)
+                resp = await self._post_validar(compAux, token)
+
+        try:
+            payload = resp.json()
+        except Exception:
+            payload = {"raw": resp.text}
+
+        return {
+            "ok": 200 <= resp.status_code < 300,
+            "status": resp.status_code,
+            "payload": payload,
+            "data_empleada": comp,
+        }
+
+    async def validar_lote(self, comps: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """ Retorna lista alineada con comps: { ok:bool, status:int, payload:dict|str, body_enviado:dict } """
+        if not comps:
+            return []
+
+        self._token = await self.prefetch_token()
+        sem = asyncio.Semaphore(SUNAT_MAX_CONCURRENCY)
+
+        return await asyncio.gather(*[self._one(sem, comp) for comp in comps])
@@ -1,5 +1,5 @@
 # app/main.py (snippet mínimo)
-import re, uuid
+import asyncio, re, uuid
 from fastapi import FastAPI, Depends, UploadFile, File, Header, HTTPException
 from fastapi.responses import JSONResponse
 
@@ -8,10 +8,11 @@ from services.firebase_service import FirebaseService
 
 app = FastAPI(title="Comprobantes API - Simple Upload")
 
+_FN_INVALID = re.compile(r"[^\w.\-]")
+_FN_MULTI_US = re.compile(r"_+")
+
 def sanitize_filename(name: str) -> str:
-    name = name or "archivo"
-    name = re.sub(r"[^\w.\-]", "_", name)
-    return re.sub(r"_+", "_", name).lower()
+    return _FN_MULTI_US.sub("_", _FN_INVALID.sub("_", name or "archivo")).lower()
 
 @app.post("/api/upload")
 async def simple_upload(
@@ -28,10 +29,12 @@ async def simple_upload(
         safe_name = sanitize_filename(file.filename or "archivo")
         object_path = f"uploads/users/{uid}/{comp_id}/{safe_name}"
 
-        contents = await file.read()
-        up = fb.upload_bytes_and_url(
+        # Se sube desde el archivo temporal de Starlette, sin file.read() completo en RAM,
+        # y en un hilo para no bloquear el event loop durante la subida
+        up = await asyncio.to_thread(
+            fb.upload_file_and_url,
             object_path,
-            contents,
+            file.file,
             content_type=file.content_type or "application/octet-stream"
         )
 
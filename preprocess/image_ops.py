@@ -3,12 +3,29 @@ from __future__ import annotations
 from dataclasses import dataclass, field
 from typing import List, Tuple, Optional, Dict
 from io import BytesIO
+import threading
 
-from PIL import Image, ImageOps, ImageFilter
+from PIL import Image, ImageOps
 import pytesseract
 import cv2
 import numpy as np
 
+try:
+    # OSD en proceso, sin lanzar el binario en cada llamada (la imagen Docker lo compila contra libtesseract)
+    from tesserocr import PyTessBaseAPI, PSM
+except ImportError:
+    PyTessBaseAPI = None
+
+# T-API: con OpenCL disponible (p. ej. iGPU) resize/warpAffine de imagen completa corren vía UMat.
+# Se desactiva con la variable estándar de OpenCV OPENCV_OPENCL_RUNTIME=disabled.
+_USE_OPENCL = cv2.ocl.haveOpenCL()
+
+def _umat(img: np.ndarray):
+    return cv2.UMat(img) if _USE_OPENCL else img
+
+def _mat(img) -> np.ndarray:
+    return img.get() if isinstance(img, cv2.UMat) else img
+
 @dataclass
 class PreprocessMeta:
     steps: List[str] = field(default_factory=list)
@@ -19,13 +36,17 @@ class PreprocessMeta:
     width: Optional[int] = None
     height: Optional[int] = None
 
-def _pil_to_cv2(img: Image.Image) -> np.ndarray:
-    arr = np.array(img.convert("RGB"))
-    return cv2.cvtColor(arr, cv2.COLOR_RGB2BGR)
+# Modos de PIL que cv2 pasa a gris directo desde el buffer, sin img.convert() previo
+_GRAY_CODES = {"RGB": cv2.COLOR_RGB2GRAY, "RGBA": cv2.COLOR_RGBA2GRAY}
 
-def _cv2_to_pil(img_cv: np.ndarray) -> Image.Image:
-    rgb = cv2.cvtColor(img_cv, cv2.COLOR_BGR2RGB)
-    return Image.fromarray(rgb)
+def _to_gray(img: Image.Image) -> np.ndarray:
+    # uint8 2-D directo desde el buffer de PIL (mismos pesos 0.299/0.587/0.114 en ambos)
+    if img.mode == "L":
+        return np.asarray(img)
+    code = _GRAY_CODES.get(img.mode)
+    if code is not None:
+        return cv2.cvtColor(np.asarray(img), code)
+    return np.asarray(img.convert("L"))
 
 def _apply_exif(img: Image.Image, meta: PreprocessMeta) -> Image.Image:
     before = (img.width, img.height)
@@ -35,70 +56,206 @@ def _apply_exif(img: Image.Image, meta: PreprocessMeta) -> Image.Image:
         meta.steps.append("exif_transpose")
     return img2
 
+def _osd_input(img: Image.Image, max_side: int = 600) -> Image.Image:
+    """
+    OSD solo necesita la forma gruesa de los glifos: gris y lado mayor <= max_side
+    reduce 20-50x los píxeles que analiza Tesseract en fotos de celular.
+    """
+    gray = img if img.mode == "L" else img.convert("L")
+    s = max_side / max(gray.size)
+    if s < 1.0:
+        gray = gray.resize((max(1, int(gray.width * s)), max(1, int(gray.height * s))), Image.BILINEAR)
+    return gray
+
+# Un handle de Tesseract por proceso (osd.traineddata queda cargado); no es thread-safe.
+# None: aún no se crea; False: tesserocr no está o su init falló -> se usa pytesseract.
+_OSD_API = None if PyTessBaseAPI is not None else False
+_OSD_LOCK = threading.Lock()
+
+def _osd_api():
+    # Llamar con _OSD_LOCK tomado; el init se intenta una sola vez por proceso
+    global _OSD_API
+    if _OSD_API is None:
+        try:
+            _OSD_API = PyTessBaseAPI(psm=PSM.OSD_ONLY)
+        except Exception as e:
+            print(f"tesserocr no pudo iniciar OSD, se usa pytesseract: {e}")
+            _OSD_API = False
+    return _OSD_API or None
+
 def _osd_orientation(img: Image.Image) -> Tuple[Optional[int], Optional[float]]:
     """
     Usa OSD de Tesseract para estimar orientación (0/90/180/270) y confianza.
     Devuelve (angle, conf) o (None, None) si falla.
     """
+    osd_img = _osd_input(img)
     try:
-        osd = pytesseract.image_to_osd(img, output_type=pytesseract.Output.DICT)
+        if _OSD_API is not False:
+            with _OSD_LOCK:
+                api = _osd_api()
+                res = None
+                if api is not None:
+                    api.SetImage(osd_img)
+                    res = api.DetectOrientationScript()
+            if api is not None:
+                if not res:
+                    return None, None
+                # Igual que el "Rotate" de image_to_osd: giro que corrige la orientación detectada
+                return (360 - int(res["orient_deg"])) % 360, float(res["orient_conf"])
+        osd = pytesseract.image_to_osd(osd_img, output_type=pytesseract.Output.DICT)
         angle = int(osd.get("rotate", 0))
         conf = float(osd.get("orientation_confidence", 0.0))
         return angle, conf
     except Exception:
         return None, None
 
+def _jpeg_draft(img: Image.Image, meta: PreprocessMeta, max_side: int = 1800) -> None:
+    """
+    Para JPEG, pide a libjpeg una decodificación reducida (1/2, 1/4, 1/8) en gris, en el dominio DCT.
+    La caja se calcula según el aspecto: draft garantiza ambos lados >= lo pedido, y el resultado
+    sigue cubriendo el max_side que luego usa _normalize_size.
+    """
+    if img.format != "JPEG":
+        return
+    s = max_side / max(img.size)
+    if s >= 1.0:
+        return
+    box = (int(np.ceil(img.width * s)), int(np.ceil(img.height * s)))
+    if img.draft("L", box):
+        meta.steps.append("jpeg_draft")
+
 def _normalize_size(img_cv: np.ndarray, max_side: int = 1800) -> np.ndarray:
     h, w = img_cv.shape[:2]
     scale = min(1.0, max_side / max(h, w))
     if scale < 1.0:
-        img_cv = cv2.resize(img_cv, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+        img_cv = _mat(cv2.resize(_umat(img_cv), (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA))
     return img_cv
 
-def _basic_enhance(img: Image.Image, meta: PreprocessMeta) -> Image.Image:
-    # Filtro leve + sharpen
-    img2 = img.convert("L")
-    img2 = img2.filter(ImageFilter.MedianFilter(size=3))
-    img2 = img2.filter(ImageFilter.UnsharpMask(radius=1.0, percent=150, threshold=3))
-    meta.steps.append("enhance_basic")
-    return img2
+def _basic_enhance(gray: np.ndarray, meta: Optional[PreprocessMeta] = None) -> np.ndarray:
+    # Filtro leve + sharpen (mediana 3x3 + unsharp mask radio 1, 150%) con los filtros SIMD de OpenCV
+    gray = cv2.medianBlur(gray, 3)
+    blur = cv2.GaussianBlur(gray, (0, 0), 1.0)
+    gray = cv2.addWeighted(gray, 2.5, blur, -1.5, 0)  # gray + 1.5 * (gray - blur), saturado a uint8
+    if meta:
+        meta.steps.append("enhance_basic")
+    return gray
 
-def _adaptive_binarize(img_cv: np.ndarray, meta: PreprocessMeta) -> np.ndarray:
-    gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY) if len(img_cv.shape) == 3 else img_cv
-    bin_img = cv2.adaptiveThreshold(
-        gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-        cv2.THRESH_BINARY, 31, 15
-    )
-    meta.steps.append("adaptive_binarize")
-    return cv2.cvtColor(bin_img, cv2.COLOR_GRAY2BGR)
-
-def _deskew(img_cv: np.ndarray, meta: PreprocessMeta, max_angle: float = 5.0) -> np.ndarray:
-    # Deskew rápido basado en umbral + minAreaRect (solo pequeños ángulos)
-    gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY)
-    th = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
-    coords = np.column_stack(np.where(th == 0))
-    if coords.size == 0:
-        return img_cv
-    rect = cv2.minAreaRect(coords)
-    angle = rect[-1]
-    if angle < -45:
-        angle = 90 + angle
-    if abs(angle) < 0.5 or abs(angle) > max_angle:
+def _adaptive_binarize(img_cv: np.ndarray, meta: Optional[PreprocessMeta] = None, block: int = 31, c: int = 15) -> np.ndarray:
+    """
+    Umbral adaptativo por media local block x block (gray > media - c) usando una imagen integral:
+    O(1) por píxel en vez de la convolución gaussiana de 31x31 de cv2.adaptiveThreshold.
+    """
+    gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY) if img_cv.ndim == 3 else img_cv
+    h, w = gray.shape[:2]
+    r = block // 2
+    padded = cv2.copyMakeBorder(gray, r, r, r, r, cv2.BORDER_REPLICATE)
+    # int32 alcanza para imágenes <= ~2900x2900; más grandes, float64 (exacto hasta 2^53)
+    sdepth = cv2.CV_32S if padded.size * 255 < 2**31 else cv2.CV_64F
+    ii = cv2.integral(padded, sdepth=sdepth)
+    win = ii[block:block + h, block:block + w] - ii[:h, block:block + w] - ii[block:block + h, :w] + ii[:h, :w]
+    # gray > win/n - c  <=>  gray*n > win - c*n  (sin divisiones)
+    n = block * block
+    bin_img = np.where(gray.astype(win.dtype) * n > win - c * n, 255, 0).astype(np.uint8)
+    if meta:
+        meta.steps.append("adaptive_binarize")
+    return bin_img
+
+# Filas por banda: cada banda pasa por todas las etapas mientras sigue en caché L2
+BAND_ROWS = 256
+# Filas de contexto por lado: mediana 3x3 (1) + gaussiana sigma 1 (3) + ventana 31x31 (15)
+BAND_HALO = 20
+
+def _enhance_binarize_tiled(gray: np.ndarray, meta: PreprocessMeta, band: int = BAND_ROWS, halo: int = BAND_HALO) -> np.ndarray:
+    """
+    _basic_enhance + _adaptive_binarize por bandas de filas (con halo), en lugar de dos pasadas
+    sobre la imagen completa. El resultado es idéntico al de aplicar ambas etapas de una vez.
+    """
+    h = gray.shape[0]
+    out = np.empty_like(gray)
+    for y in range(0, h, band):
+        y0, y1 = max(0, y - halo), min(h, y + band + halo)
+        tile = _adaptive_binarize(_basic_enhance(gray[y0:y1]))
+        rows = min(band, h - y)
+        out[y:y + rows] = tile[y - y0:y - y0 + rows]
+    meta.steps += ["enhance_basic", "adaptive_binarize"]
+    return out
+
+def _otsu_threshold(gray: np.ndarray) -> int:
+    """
+    Otsu vectorizado sobre el histograma de 256 bins: argmax de la varianza entre clases
+    para todos los umbrales a la vez, sin barrer la imagen más que una vez.
+    """
+    hist = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel().astype(np.float64)
+    w = np.cumsum(hist)                     # píxeles en la clase "fondo" (<= t)
+    mu = np.cumsum(hist * np.arange(256))   # suma de intensidades de esa clase
+    n, mu_t = w[-1], mu[-1]
+    denom = w * (n - w)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sigma_b = np.where(denom > 0, (mu_t * w - mu * n) ** 2 / denom, 0.0)
+    return int(np.argmax(sigma_b))
+
+def _skew_angle(th: np.ndarray, max_angle: float, step: float = 0.25) -> Optional[float]:
+    """
+    Estima la inclinación por perfil de proyección: el ángulo que, al rotar, maximiza la varianza
+    de la suma por filas (líneas de texto bien horizontales). 'th' es la máscara binaria reducida.
+    Devuelve None si no hay tinta o si el óptimo cae en el borde del rango (inclinación fuera de rango).
+    """
+    ink = cv2.bitwise_not(th)  # texto (negro) -> valores altos
+    pts = cv2.findNonZero(ink)
+    if pts is None:
+        return None
+    # Solo se barre la caja de la tinta (más un margen para lo que el giro saca de ella)
+    x, y, bw, bh = cv2.boundingRect(pts)
+    pad = int(np.ceil(max(bw, bh) * np.tan(np.radians(max_angle)) / 2)) + 1
+    ih, iw = ink.shape[:2]
+    ink = ink[max(0, y - pad):min(ih, y + bh + pad), max(0, x - pad):min(iw, x + bw + pad)]
+
+    sh, sw = ink.shape[:2]
+    center = (sw / 2, sh / 2)
+    best_angle, best_score = 0.0, -1.0
+    for a in np.arange(-max_angle, max_angle + step / 2, step):
+        M = cv2.getRotationMatrix2D(center, float(a), 1.0)
+        rotated = cv2.warpAffine(ink, M, (sw, sh), flags=cv2.INTER_NEAREST, borderValue=0)
+        score = float(np.var(rotated.sum(axis=1, dtype=np.int64)))
+        if score > best_score:
+            best_angle, best_score = float(a), score
+
+    if abs(best_angle) >= max_angle:
+        return None
+    return best_angle
+
+def _deskew(img_cv: np.ndarray, meta: PreprocessMeta, max_angle: float = 5.0, max_side: int = 400) -> np.ndarray:
+    # Deskew rápido por perfil de proyección sobre imagen reducida (solo pequeños ángulos)
+    gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY) if img_cv.ndim == 3 else img_cv
+    (h, w) = gray.shape[:2]
+    scale = min(1.0, max_side / max(h, w))
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1.0 else gray
+    th = np.where(small > _otsu_threshold(small), 255, 0).astype(np.uint8)
+    angle = _skew_angle(th, max_angle)
+    if angle is None or abs(angle) < 0.5:
         return img_cv
-    (h, w) = img_cv.shape[:2]
+    # Solo la imagen completa se rota, una vez, con el ángulo elegido.
+    # Sobre la imagen ya binarizada basta vecino más cercano (y la salida sigue siendo 0/255).
+    interp = cv2.INTER_NEAREST if "adaptive_binarize" in meta.steps else cv2.INTER_LINEAR
     M = cv2.getRotationMatrix2D((w // 2, h // 2), angle, 1.0)
-    rotated = cv2.warpAffine(img_cv, M, (w, h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    rotated = _mat(cv2.warpAffine(_umat(img_cv), M, (w, h), flags=interp, borderMode=cv2.BORDER_REPLICATE))
     meta.steps.append(f"deskew_{angle:.2f}")
     return rotated
 
+# Giro horario de 90/180/270 como transposición pura (sin remuestreo)
+_CW_TRANSPOSE = (Image.Transpose.ROTATE_270, Image.Transpose.ROTATE_180, Image.Transpose.ROTATE_90)
+
 def rotate_by_angle(img: Image.Image, angle: int, meta: Optional[PreprocessMeta] = None) -> Image.Image:
     """
-    Rota imagen en múltiplos de 90 (0, 90, 180, 270).
+    Rota imagen en múltiplos de 90 (0, 90, 180, 270), en sentido horario.
     """
-    if angle % 360 == 0:
-        return img
-    k = (angle // 90) % 4
-    img2 = img.rotate(-angle, expand=True) if angle not in (90, 180, 270) else img.transpose([Image.ROTATE_270, Image.ROTATE_180, Image.ROTATE_90][k-1])
+    if angle % 90 != 0:
+        img2 = img.rotate(-angle, expand=True, resample=Image.NEAREST)
+    else:
+        k = (angle // 90) % 4
+        if k == 0:
+            return img
+        img2 = img.transpose(_CW_TRANSPOSE[k - 1])
     if meta:
         meta.rotated_final = (meta.rotated_final or 0) + angle
         meta.steps.append(f"rotate_{angle}")
@@ -111,11 +268,12 @@ def process_image(image_bytes: bytes, use_gpt_orientation: bool = False) -> Tupl
       2) OSD (pytesseract) → rotación 0/90/180/270 si conf >= umbral
       3) Realce básico + binarización adaptativa
       4) Deskew leve (<= ~5°)
-    Retorna bytes PNG y metadatos (para logging).
+    Retorna bytes (PNG 1 bit si se binarizó, si no JPEG) y metadatos (para logging).
     """
     meta = PreprocessMeta()
     img = Image.open(BytesIO(image_bytes))
     meta.width, meta.height = img.size
+    _jpeg_draft(img, meta)
 
     # 1) EXIF
     img = _apply_exif(img, meta)
@@ -127,15 +285,19 @@ def process_image(image_bytes: bytes, use_gpt_orientation: bool = False) -> Tupl
         if angle != 0:
             img = rotate_by_angle(img, angle, meta)
 
-    # 3) Enhancements + 4) Deskew
-    img = _basic_enhance(img, meta)
-    cv = _pil_to_cv2(img)
+    # 3) Enhancements (por bandas) + 4) Deskew, sobre uint8 2-D de aquí en adelante
+    cv = _to_gray(img)
     cv = _normalize_size(cv)
-    cv = _adaptive_binarize(cv, meta)
+    cv = _enhance_binarize_tiled(cv, meta)
     cv = _deskew(cv, meta)
-    out = _cv2_to_pil(cv)
+    out = Image.fromarray(cv)
 
-    # salida png
     buf = BytesIO()
-    out.save(buf, format="PNG", optimize=True)
+    if "adaptive_binarize" in meta.steps:
+        # Binaria: PNG de 1 bit (8 px por byte antes del deflate), deflate nivel 1.
+        # Sin dither: los valores ya son 0/255.
+        out.convert("1", dither=Image.Dither.NONE).save(buf, format="PNG", optimize=False, compress_level=1)
+    else:
+        # Tono continuo: JPEG es mucho más chico y rápido que PNG
+        out.save(buf, format="JPEG", quality=85, progressive=True)
     return buf.getvalue(), meta
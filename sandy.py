@@ -1,34 +1,62 @@
 import re, uuid
-from fastapi import FastAPI, UploadFile, File, Header
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, UploadFile, File, Header, Depends
+from fastapi.responses import ORJSONResponse
 from typing import List
 from apis.api_sunat import SunatClient
 from services.orchestator import Orchestator
+from services.deps import aclose_clients, get_llm_semaphore, get_orchestator, get_sunat, init_clients
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    try:
+        init_clients(app)
+        yield
+    finally:
+        await aclose_clients(app)
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+
+def _descartar(task: asyncio.Task) -> None:
+    # Cancela el prefetch y recoge su excepción si ya terminó, para que no quede "never retrieved"
+    task.cancel()
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
 
 @app.post("/procesar_comprobantes")
-async def procesar_comprobantes(archivos: List[UploadFile] = File(...), x_uid: str | None = Header(default=None)):
-    orch = Orchestator()
-    
-    comprobantes_datos = await orch.proc_arch(archivos, x_uid)
+async def procesar_comprobantes(
+    archivos: List[UploadFile] = File(...),
+    x_uid: str | None = Header(default=None),
+    sem: asyncio.Semaphore = Depends(get_llm_semaphore),
+    orch: Orchestator = Depends(get_orchestator),
+    consultorSunat: SunatClient = Depends(get_sunat),
+):
+    # El token de SUNAT se pide mientras corre la extracción, no después
+    token_task = asyncio.create_task(consultorSunat.prefetch_token())
+
+    try:
+        comprobantes_datos = await orch.proc_arch(archivos, x_uid, sem)
+    except BaseException:
+        _descartar(token_task)
+        raise
 
     comprobantes_ok = []
     comprobantes_not_ok = []
     comprobantes_fail = []
 
+    # Una pasada: faltantes == 0 -> ok, otro entero -> not_ok; error/excepción/sin dato -> fail
     for comp in comprobantes_datos:
-
-        if(comp['comp_data']['faltantes']):
-            if(comp['comp_data']['faltantes'] == 0):
-                comprobantes_ok.append(comp)        
-            else:
-                comprobantes_not_ok.append(comp)
-        else:
-            comprobantes_fail.append(comp)
-
-    consultorSunat = SunatClient()
-
-    resultados_sunat = consultorSunat.validar_lote(comprobantes_ok)
+        data = comp.get('comp_data')
+        f = data.get('faltantes') if isinstance(data, dict) else None
+        (comprobantes_ok if f == 0 else comprobantes_not_ok if isinstance(f, int) else comprobantes_fail).append(comp)
+
+    if comprobantes_ok:
+        await token_task
+        resultados_sunat = await consultorSunat.validar_lote(comprobantes_ok)
+    else:
+        # Sin nada que validar, un fallo del OAuth de SUNAT no debe tumbar la petición
+        _descartar(token_task)
+        resultados_sunat = []
 
     return {"total":len(comprobantes_datos), 
             "total_ok":len(comprobantes_ok), 
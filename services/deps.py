@@ -1,5 +1,40 @@
 # app/deps.py
+import asyncio
+
+from fastapi import FastAPI, Request
+
+from apis.api_sunat import SunatClient
 from services.firebase_service import FirebaseService
+from services.orchestator import MAX_CONCURRENCIA, Orchestator
 
-def get_firebase():
+# Los providers son async: corren en el event loop (no en el threadpool), sin carreras al crear nada
+
+async def get_firebase() -> FirebaseService:
     return FirebaseService.instance()
+
+def init_clients(app: FastAPI) -> None:
+    """ Crea UNA vez por proceso (desde el lifespan) los objetos compartidos por todas las peticiones. """
+    # Acota el total de llamadas salientes del proceso
+    app.state.llm_semaphore = asyncio.Semaphore(MAX_CONCURRENCIA)
+    # Un solo cliente de Gemini (y pool de preprocesado): reutiliza conexiones HTTP entre peticiones
+    app.state.orchestator = Orchestator(firebase=FirebaseService.instance())
+    # Valida el RUC consultante una vez y comparte el pool HTTP de SUNAT
+    app.state.sunat = SunatClient()
+
+async def aclose_clients(app: FastAPI) -> None:
+    # Solo cierra lo que llegó a crearse
+    sunat = getattr(app.state, "sunat", None)
+    if sunat is not None:
+        await sunat.aclose()
+    orch = getattr(app.state, "orchestator", None)
+    if orch is not None:
+        orch.close()
+
+async def get_orchestator(request: Request) -> Orchestator:
+    return request.app.state.orchestator
+
+async def get_sunat(request: Request) -> SunatClient:
+    return request.app.state.sunat
+
+async def get_llm_semaphore(request: Request) -> asyncio.Semaphore:
+    return request.app.state.llm_semaphore
@@ -1,8 +1,9 @@
 
 # app/services/firebase_service.py
 from __future__ import annotations
-import re, uuid
-from typing import Any, Dict, Optional
+import asyncio, re, secrets
+from io import BytesIO
+from typing import Any, BinaryIO, Dict, Optional
 from urllib.parse import quote
 import os
 from dotenv import load_dotenv
@@ -14,6 +15,11 @@ load_dotenv()
 
 FB_STORAGE_BUCKET = os.getenv("FB_STORAGE_BUCKET", "")
 GOOGLE_APPLICATION_CREDENTIALS = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "")
+# Hasta 8 MiB la subida es un solo request multipart; más grande, resumable en trozos de este tamaño
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+_FN_INVALID = re.compile(r"[^\w.\-]")
+_FN_MULTI_US = re.compile(r"_+")
 
 class FirebaseService:
     """
@@ -41,28 +47,44 @@ class FirebaseService:
     def _download_url(bucket_name: str, object_path: str, token: str) -> str:
         return f"https://firebasestorage.googleapis.com/v0/b/{bucket_name}/o/{quote(object_path, safe='')}?alt=media&token={token}"
 
-    def upload_bytes_and_url(self, object_path: str, data: bytes, content_type: str = "application/octet-stream") -> Dict[str, Any]:
+    def _new_blob(self, object_path: str):
         """
-        Sube bytes a Storage y retorna metadatos + URL estable (tokenizada).
+        Blob con el token de descarga ya en su metadata inicial: se envía junto con el contenido
+        y evita el patch() + reload() (dos round trips) después de subir.
         """
-        blob = self.bucket.blob(object_path)
-        blob.upload_from_string(data, content_type=content_type)
-
-        token = str(uuid.uuid4())
-        md = blob.metadata or {}
-        md["firebaseStorageDownloadTokens"] = token
-        blob.metadata = md
-        blob.patch()
+        token = secrets.token_urlsafe(16)
+        blob = self.bucket.blob(object_path, chunk_size=UPLOAD_CHUNK_SIZE)
+        blob.metadata = {"firebaseStorageDownloadTokens": token}
+        return blob, token
 
-        blob.reload()
+    def _upload_result(self, object_path: str, token: str, size: int, content_type: str) -> Dict[str, Any]:
         return {
             "bucket": self.bucket.name,
             "path": object_path,
-            "size": blob.size,
-            "mime": blob.content_type,
+            "size": size,
+            "mime": content_type,
             "url": self._download_url(self.bucket.name, object_path, token),
         }
 
+    def upload_bytes_and_url(self, object_path: str, data: bytes, content_type: str = "application/octet-stream") -> Dict[str, Any]:
+        """
+        Sube bytes a Storage y retorna metadatos + URL estable (tokenizada).
+        """
+        blob, token = self._new_blob(object_path)
+        blob.upload_from_file(BytesIO(data), size=len(data), content_type=content_type)
+        return self._upload_result(object_path, token, len(data), content_type)
+
+    def upload_file_and_url(self, object_path: str, fileobj: BinaryIO, content_type: str = "application/octet-stream") -> Dict[str, Any]:
+        """
+        Igual que upload_bytes_and_url, pero lee desde un archivo (p. ej. UploadFile.file, ya spooled
+        a disco por Starlette) sin cargarlo completo en memoria.
+        """
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell()
+        blob, token = self._new_blob(object_path)
+        blob.upload_from_file(fileobj, rewind=True, size=size, content_type=content_type)
+        return self._upload_result(object_path, token, size, content_type)
+
     # -------- Firestore: Comprobantes --------
     def save_comprobante(self, uid: str, comp_id: str, payload: Dict[str, Any]) -> str:
         ref = self.db.document(f"users/{uid}/comprobantes/{comp_id}")
@@ -79,13 +101,15 @@ class FirebaseService:
         try:
             print("ejecutando simple upload para: ", filename)
             uid = x_uid or "demo-uid"
-            comp_id = str(uuid.uuid4())
+            comp_id = secrets.token_urlsafe(16)
             safe_name = self.sanitize_filename(filename or "archivo")
             object_path = f"uploads/users/{uid}/{comp_id}/{safe_name}"
 
             print("alosihola1")
 
-            up = self.upload_bytes_and_url(
+            # La subida es bloqueante: se corre en un hilo
+            up = await asyncio.to_thread(
+                self.upload_bytes_and_url,
                 object_path,
                 content,
                 content_type or "application/octet-stream"
@@ -107,7 +131,7 @@ class FirebaseService:
                         "obs": e
                     }
    
+    @staticmethod
     def sanitize_filename(name: str) -> str:
         name = name or "archivo"
-        name = re.sub(r"[^\w.\-]", "_", name)
-        return re.sub(r"_+", "_", name).lower()
+        return _FN_MULTI_US.sub("_", _FN_INVALID.sub("_", name)).lower()
@@ -0,0 +1,114 @@
+# services/llm_cache.py
+"""
+Caché de extracciones del LLM direccionada por contenido.
+La clave es sha256(bytes):modelo:versión_prompt; cada entrada es un JSON en LLM_CACHE_DIR
+nombrado con el sha256 de esa clave (el modelo puede traer '/', p. ej. "models/gemini-2.5-flash").
+Las entradas vencidas y las que pasan de LLM_CACHE_MAX_ENTRIES se barren en segundo plano.
+"""
+from __future__ import annotations
+import asyncio, hashlib, json, os, threading, time
+from typing import Any, Dict, Optional
+
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", ".cache/llm")
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))  # 7 días
+LLM_CACHE_DISABLED = os.getenv("LLM_CACHE_DISABLED", "0") == "1"
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000"))
+LLM_CACHE_SWEEP_EVERY = int(os.getenv("LLM_CACHE_SWEEP_EVERY", "3600"))  # segundos entre barridos
+
+# Desde este tamaño el hash se calcula en un hilo (hashlib libera el GIL) para no bloquear el event loop
+HASH_IN_THREAD_MIN = 1024 * 1024
+
+def digest(data: bytes) -> str:
+    # No es un uso criptográfico: permite backends más rápidos en builds FIPS de OpenSSL
+    return hashlib.sha256(data, usedforsecurity=False).hexdigest()
+
+async def digest_async(data: bytes) -> str:
+    if len(data) >= HASH_IN_THREAD_MIN:
+        return await asyncio.to_thread(digest, data)
+    return digest(data)
+
+def cache_key(data_digest: str, model: str, prompt_version: str) -> Optional[str]:
+    """ Clave a partir de un digest ya calculado (p. ej. por el orquestador); None si la caché está deshabilitada. """
+    if LLM_CACHE_DISABLED:
+        return None
+    return f"{data_digest}:{model}:{prompt_version}"
+
+async def cache_key_async(data: bytes, model: str, prompt_version: str) -> Optional[str]:
+    """ Igual que cache_key, pero hashea 'data'; no hashea nada si la caché está deshabilitada. """
+    if LLM_CACHE_DISABLED:
+        return None
+    return cache_key(await digest_async(data), model, prompt_version)
+
+_last_sweep = 0.0
+_sweep_lock = threading.Lock()
+
+def _path(key: str) -> str:
+    # Nombre plano y seguro en cualquier SO, sin ':' ni '/' del nombre del modelo
+    return os.path.join(LLM_CACHE_DIR, digest(key.encode("utf-8")) + ".json")
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _sweep() -> None:
+    """ Borra entradas vencidas (y .tmp huérfanos) y, si sobran, las más antiguas hasta LLM_CACHE_MAX_ENTRIES. """
+    now = time.time()
+    vivas = []
+    try:
+        with os.scandir(LLM_CACHE_DIR) as it:
+            for entry in it:
+                try:
+                    mtime = entry.stat().st_mtime
+                except OSError:
+                    continue
+                if now - mtime > LLM_CACHE_TTL:
+                    _remove(entry.path)
+                elif entry.name.endswith(".json"):
+                    vivas.append((mtime, entry.path))
+    except OSError:
+        return
+    sobrantes = len(vivas) - LLM_CACHE_MAX_ENTRIES
+    if sobrantes > 0:
+        vivas.sort()
+        for _, path in vivas[:sobrantes]:
+            _remove(path)
+
+def _maybe_sweep() -> None:
+    # A lo sumo un barrido cada LLM_CACHE_SWEEP_EVERY, en un hilo para no bloquear el event loop
+    global _last_sweep
+    with _sweep_lock:
+        now = time.time()
+        if now - _last_sweep < LLM_CACHE_SWEEP_EVERY:
+            return
+        _last_sweep = now
+    threading.Thread(target=_sweep, name="llm-cache-sweep", daemon=True).start()
+
+def get(key: Optional[str]) -> Optional[Dict[str, Any]]:
+    if LLM_CACHE_DISABLED or key is None:
+        return None
+    path = _path(key)
+    try:
+        if time.time() - os.path.getmtime(path) > LLM_CACHE_TTL:
+            os.remove(path)
+            return None
+        with open(path, "r", encoding="utf-8") as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+def set(key: Optional[str], value: Dict[str, Any]) -> None:
+    if LLM_CACHE_DISABLED or key is None:
+        return
+    path = _path(key)
+    try:
+        os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(value, fh, ensure_ascii=False)
+        os.replace(tmp, path)  # escritura atómica
+    except (OSError, TypeError, ValueError) as e:
+        print(f"No se pudo escribir la caché LLM ({key}): {e}")
+        return
+    _maybe_sweep()
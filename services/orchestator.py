@@ -1,39 +1,181 @@
-from apis.api_gemini import ExtractorGemini
+from apis.api_gemini import ExtractorGemini, sniff_mime
+from preprocess.image_ops import process_image
+from services import llm_cache
 from services.firebase_service import FirebaseService
 
+from cachetools import TTLCache
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
 import asyncio
+import multiprocessing
+import os
+from typing import Any, Dict, List, Optional
+
+# Máximo de llamadas salientes a la vez (lotes a Gemini + subidas)
+MAX_CONCURRENCIA = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+
+# Preprocesar imágenes (OSD + OpenCV) antes de mandarlas a Gemini; es CPU-bound y va a un pool de procesos
+PREPROCESS_IMAGES = os.getenv("PREPROCESS_IMAGES", "0") == "1"
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", str(os.cpu_count() or 1)))
+_PREPROCESABLES = {"image/jpeg", "image/png", "image/webp"}
+
+# Caché en memoria por sha256 del archivo subido: (h, "comp") -> extracción, (h, "pre") -> imagen preprocesada
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "4096"))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", "86400"))
 
 class Orchestator:
 
     
-    def __init__(self):
-        self.extractor = ExtractorGemini()
-        self.firebase = FirebaseService()
+    def __init__(self, extractor: Optional[ExtractorGemini] = None, firebase: Optional[FirebaseService] = None):
+        self.extractor = extractor or ExtractorGemini()
+        self.firebase = firebase or FirebaseService.instance()
+        # 'spawn': no se hace fork de un proceso con hilos y event loop corriendo
+        self.pool = ProcessPoolExecutor(
+            max_workers=PREPROCESS_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        ) if PREPROCESS_IMAGES else None
+        self.cache: TTLCache = TTLCache(maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL)
+
+    def close(self) -> None:
+        # Al apagar la app: descarta lo encolado y espera a que terminen los workers de preprocesado
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+
+    async def _preprocesar(self, h: str, data: bytes) -> bytes:
+        """ Devuelve la imagen preprocesada (PNG 1 bit / JPEG); PDFs y fallos pasan con los bytes originales. """
+        if self.pool is None or sniff_mime(data) not in _PREPROCESABLES:
+            return data
+        cached = self.cache.get((h, "pre"))
+        if cached is not None:
+            return cached
+        loop = asyncio.get_running_loop()
+        try:
+            out, _meta = await loop.run_in_executor(self.pool, process_image, data)
+            self.cache[(h, "pre")] = out
+            return out
+        except Exception as e:
+            print(f"Preprocesado falló, se envía la imagen original: {e}")
+            return data
 
-    async def proc_arch(self, archivos, x_uid: str):
-        comprobantes = []
+    async def proc_arch(self, archivos, x_uid: str, sem: Optional[asyncio.Semaphore] = None):
+        """
+        Pipeline por etapas conectadas con colas, para que la subida del archivo N se solape
+        con la extracción de los anteriores y la lectura de los siguientes:
+            lector -> subidores (Firebase)
+            lector -> preparador (hash + caché + preprocesado) -> extractor (lotes a Gemini)
+        """
+        if sem is None:
+            sem = asyncio.Semaphore(MAX_CONCURRENCIA)
 
-        for archivo in archivos:
-            # Snapshot de metadatos
-            content_type = getattr(archivo, "content_type", None) or "application/octet-stream"
+        n = len(archivos)
+        comps: List[Any] = [None] * n
+        urls: List[Any] = [None] * n
+        n_subidores = max(1, min(n, MAX_CONCURRENCIA))
+        q_subir: asyncio.Queue = asyncio.Queue()
+        q_preparar: asyncio.Queue = asyncio.Queue()
+        q_extraer: asyncio.Queue = asyncio.Queue()
+        hashes: Dict[int, str] = {}
+        # Un solo sha256 por archivo original, y solo si alguna caché lo va a usar
+        hashear = not llm_cache.LLM_CACHE_DISABLED or self.pool is not None
 
-            # Leer una sola vez
-            data = await archivo.read()
+        async def lector():
+            try:
+                for i, archivo in enumerate(archivos):
+                    # Leer una sola vez; los mismos bytes van a ambas ramas
+                    try:
+                        data = await archivo.read()
+                    except Exception as e:
+                        # El archivo ilegible no entra a ninguna rama; el resto sigue
+                        comps[i] = urls[i] = e
+                        continue
+                    q_subir.put_nowait((i, data))
+                    q_preparar.put_nowait((i, data))
+            finally:
+                # Los centinelas salen siempre, para que ninguna etapa quede esperando en get()
+                for _ in range(n_subidores):
+                    q_subir.put_nowait(None)
+                q_preparar.put_nowait(None)
 
-            # Lanzar en paralelo usando los mismos bytes
-            comp_task = asyncio.create_task(self.extractor.extraer_datos(data, archivo.filename))
-            up_task   = asyncio.create_task(self.firebase.simple_upload(x_uid, data, archivo.filename, content_type))
+        async def subidor():
+            while (item := await q_subir.get()) is not None:
+                i, data = item
+                archivo = archivos[i]
+                # Snapshot de metadatos
+                content_type = getattr(archivo, "content_type", None) or "application/octet-stream"
+                try:
+                    async with sem:
+                        urls[i] = await self.firebase.simple_upload(x_uid, data, archivo.filename, content_type)
+                except Exception as e:
+                    urls[i] = e
 
-            comp, url = await asyncio.gather(comp_task, up_task, return_exceptions=True)
+        async def _preparar(i, data):
+            try:
+                if not hashear:
+                    q_extraer.put_nowait((i, data))
+                    return
+                h = hashes[i] = await llm_cache.digest_async(data)
+                # Reenvíos del mismo comprobante: ni preprocesado ni llamada a Gemini
+                cached = None if llm_cache.LLM_CACHE_DISABLED else self.cache.get((h, "comp"))
+                if cached is not None:
+                    comps[i] = cached
+                    return
+                q_extraer.put_nowait((i, await self._preprocesar(h, data)))
+            except Exception as e:
+                comps[i] = e
 
-            comprobantes.append({
+        async def preparador():
+            tareas = []
+            while (item := await q_preparar.get()) is not None:
+                tareas.append(asyncio.create_task(_preparar(*item)))
+            await asyncio.gather(*tareas)
+            q_extraer.put_nowait(None)
+
+        async def _extraer_grupo(grupo):
+            try:
+                # La clave de la caché en disco sale del hash del archivo original (no se rehashea)
+                nuevos = await self.extractor.extraer_lote(
+                    [(data, archivos[i].filename) for i, data in grupo],
+                    sem,
+                    digests=[hashes.get(i) for i, _ in grupo],
+                )
+            except Exception as e:
+                nuevos = [e] * len(grupo)
+            for (i, _), comp in zip(grupo, nuevos):
+                comps[i] = comp
+                if isinstance(comp, dict) and "error" not in comp and not llm_cache.LLM_CACHE_DISABLED:
+                    self.cache[(hashes[i], "comp")] = comp
+
+        async def extractor():
+            # Despacha un lote a Gemini apenas hay batch_size archivos listos
+            tareas, grupo = [], []
+            while (item := await q_extraer.get()) is not None:
+                grupo.append(item)
+                if len(grupo) == self.extractor.batch_size:
+                    tareas.append(asyncio.create_task(_extraer_grupo(grupo)))
+                    grupo = []
+            if grupo:
+                tareas.append(asyncio.create_task(_extraer_grupo(grupo)))
+            await asyncio.gather(*tareas)
+
+        etapas = [asyncio.create_task(e) for e in (lector(), preparador(), extractor(), *[subidor() for _ in range(n_subidores)])]
+        try:
+            await asyncio.gather(*etapas)
+        except BaseException:
+            # Si una etapa revienta (o se cancela la petición) no quedan tareas huérfanas con los bytes
+            for t in etapas:
+                t.cancel()
+            await asyncio.gather(*etapas, return_exceptions=True)
+            raise
+
+        # Todas las listas están alineadas con 'archivos'
+        return [
+            {
                 "nom_archivo": archivo.filename,
                 "comp_data": comp,
                 "almacenado": url
-            })
-
-        return comprobantes
+            }
+            for archivo, comp, url in zip(archivos, comps, urls)
+        ]
 
     if __name__ == "__main__":
-        asyncio.run(proc_arch())
\ No newline at end of file
+        asyncio.run(proc_arch())